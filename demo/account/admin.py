@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import UserProfile, ResetPasswordToken
+from .models import AuthEvent, UserProfile, ResetPasswordToken
 
 admin.site.register(UserProfile)
 admin.site.register(ResetPasswordToken)
+admin.site.register(AuthEvent)
@@ -0,0 +1,41 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+from .sharding import directory_entry_for_user_id, shard_for_username
+
+
+class ShardedModelBackend(ModelBackend):
+    # 跟 ModelBackend 一樣用 username, password 驗證
+    # 差別在於先透過 directory 找到 user 所在的 shard 再查詢
+    #
+    # 注意: django-oauth-toolkit 的 AccessToken 只會在 default 上, 見 account.sharding
+
+    def authenticate(self, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+
+        shard = shard_for_username(username)
+        try:
+            user = UserModel._default_manager.db_manager(shard).get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # 跟 ModelBackend 一樣跑一次 hasher, 避免從回應時間看出帳號存不存在
+            UserModel().set_password(password)
+        else:
+            if user.check_password(password) and self.user_can_authenticate(user):
+                return user
+
+    def get_user(self, user_id):
+        UserModel = get_user_model()
+        shard, username = directory_entry_for_user_id(user_id)
+        try:
+            user = UserModel._default_manager.db_manager(shard).get(pk=user_id)
+        except UserModel.DoesNotExist:
+            return None
+
+        # 沒有經過 directory 建立的 user (例如升級後還沒 backfill) 的 id 可能剛好跟別人一樣
+        # 確認是 directory 記錄的那個人, 不然 session 會變成別人的帳號
+        # (django.contrib.auth.get_user 另外還會比對 session 裡的 password hash)
+        if username is not None and user.get_username() != username:
+            return None
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,178 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# 驗證相關的事件種類
+LOGIN = "login"
+LOGIN_FAILED = "login_failed"
+LOGOUT = "logout"
+SIGNUP = "signup"
+PASSWORD_CHANGE = "password_change"
+PASSWORD_CHANGE_FAILED = "password_change_failed"
+PASSWORD_RESET = "password_reset"
+PASSWORD_RESET_FAILED = "password_reset_failed"
+LOCKED_OUT = "locked_out"
+
+# 可以在 settings 裡面覆寫
+#   ACCOUNT_AUTH_EVENT_SINK: "db" 用 bulk_create 寫進 AuthEvent, "jsonl" 寫進 rotating file
+#   ACCOUNT_AUTH_EVENT_BUFFER_SIZE: ring buffer 的大小, 滿了之後新的 event 會被丟掉
+#   ACCOUNT_AUTH_EVENT_FLUSH_INTERVAL: background thread 多久 flush 一次 (秒)
+#   ACCOUNT_AUTH_EVENT_FLUSH_THRESHOLD: buffer 累積到多少筆就提早 flush
+#   ACCOUNT_AUTH_EVENT_LOG_FILE: jsonl sink 的檔案路徑
+#       每個 process 各寫一個檔案, 例如 auth_events.jsonl -> auth_events.<pid>.jsonl
+#       多個 worker 共用同一個 RotatingFileHandler 檔案的話, rotation 會把別人的檔案改名
+DEFAULT_SINK = "db"
+DEFAULT_BUFFER_SIZE = 10000
+DEFAULT_FLUSH_INTERVAL = 2.0
+DEFAULT_FLUSH_THRESHOLD = 500
+DEFAULT_LOG_FILE = "auth_events.jsonl"
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024
+LOG_FILE_BACKUP_COUNT = 5
+
+
+class AuthEventLog(object):
+    # 把驗證事件先放在 memory 裡面的 ring buffer, 由 background thread 批次寫出
+    # 這樣 login, signup 這些很常被呼叫的 API 不用每次都多一個 DB write
+    #
+    # Backpressure: buffer 滿的時候直接丟掉新的 event, 並且記錄丟掉的數量
+    # 下一次 flush 的時候會用 logger.warning 回報
+
+    def __init__(self, sink=None, buffer_size=None, flush_interval=None,
+                 flush_threshold=None, log_file=None):
+        self.sink = sink or getattr(settings, "ACCOUNT_AUTH_EVENT_SINK", DEFAULT_SINK)
+        self.buffer_size = buffer_size or getattr(
+            settings, "ACCOUNT_AUTH_EVENT_BUFFER_SIZE", DEFAULT_BUFFER_SIZE)
+        self.flush_interval = flush_interval or getattr(
+            settings, "ACCOUNT_AUTH_EVENT_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL)
+        self.flush_threshold = flush_threshold or getattr(
+            settings, "ACCOUNT_AUTH_EVENT_FLUSH_THRESHOLD", DEFAULT_FLUSH_THRESHOLD)
+        self.log_file = log_file or getattr(
+            settings, "ACCOUNT_AUTH_EVENT_LOG_FILE", DEFAULT_LOG_FILE)
+
+        self.dropped = 0
+        self._buffer = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._file_handler = None
+
+    def record(self, username, event_type, ip_address=None):
+        event = {
+            "username": username,
+            "event_type": event_type,
+            "ip_address": ip_address,
+            "created_time": timezone.now(),
+        }
+
+        with self._lock:
+            if len(self._buffer) >= self.buffer_size:
+                self.dropped += 1
+                return False
+            self._buffer.append(event)
+            pending = len(self._buffer)
+
+        self._ensure_thread()
+        if pending >= self.flush_threshold:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        # 同一時間只允許一個 flush, 避免 atexit 跟 background thread 重複寫入
+        with self._flush_lock:
+            with self._lock:
+                events = list(self._buffer)
+                self._buffer.clear()
+                dropped, self.dropped = self.dropped, 0
+
+            if dropped:
+                logger.warning("auth event buffer is full, dropped %d events", dropped)
+            if not events:
+                return 0
+
+            try:
+                if self.sink == "jsonl":
+                    self._write_jsonl(events)
+                else:
+                    self._write_db(events)
+            except Exception:
+                logger.exception("failed to flush %d auth events", len(events))
+                return 0
+
+        return len(events)
+
+    def _write_db(self, events):
+        from .models import AuthEvent
+
+        try:
+            AuthEvent.objects.bulk_create([AuthEvent(**event) for event in events])
+        finally:
+            # DB connection 是 thread local 的，不關掉的話每個 flush thread 都會留著一條
+            if threading.current_thread() is self._thread:
+                connections.close_all()
+
+    def _write_jsonl(self, events):
+        # 直接借用 RotatingFileHandler 來處理檔案大小的 rotation
+        # handler 是第一次寫入才建立的, 所以 preforking 的時候會是 fork 之後 worker 自己的 pid
+        if self._file_handler is None:
+            self._file_handler = logging.handlers.RotatingFileHandler(
+                process_log_file(self.log_file, os.getpid()), maxBytes=LOG_FILE_MAX_BYTES,
+                backupCount=LOG_FILE_BACKUP_COUNT, encoding="utf-8")
+            self._file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+        for event in events:
+            line = dict(event, created_time=event["created_time"].isoformat())
+            self._file_handler.handle(logging.makeLogRecord({
+                "msg": json.dumps(line, ensure_ascii=False),
+                "levelno": logging.INFO,
+            }))
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="auth-event-flusher", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+def process_log_file(log_file, pid):
+    root, ext = os.path.splitext(log_file)
+    return "{}.{}{}".format(root, pid, ext)
+
+
+def log_file_pattern(log_file):
+    # 所有 process 的檔案以及 rotation 之後的 backup
+    root, ext = os.path.splitext(log_file)
+    return "{}.*{}*".format(root, ext)
+
+
+auth_event_log = AuthEventLog()
+atexit.register(auth_event_log.flush)
+
+
+def get_client_ip(request):
+    return request.META.get("REMOTE_ADDR") or None
+
+
+def record_auth_event(request, event_type, username):
+    auth_event_log.record(username, event_type, get_client_ip(request))
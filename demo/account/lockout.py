@@ -0,0 +1,177 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+# 可以在 settings 裡面覆寫
+#   ACCOUNT_LOCKOUT_BACKEND: "local" 單一 process 用 memory LRU
+#       "cache" 多個 worker 或多台機器共用 Django cache
+#   ACCOUNT_LOCKOUT_CACHE_ALIAS: "cache" backend 要用哪一個 CACHES alias
+#   ACCOUNT_LOCKOUT_THRESHOLD: 連續失敗幾次之後開始鎖定
+#   ACCOUNT_LOCKOUT_BASE_SECONDS: 第一次鎖定的秒數, 之後每多失敗一次就加倍
+#   ACCOUNT_LOCKOUT_MAX_SECONDS: 鎖定秒數的上限
+#   ACCOUNT_LOCKOUT_RESET_SECONDS: 最後一次失敗之後多久清掉失敗次數
+#   ACCOUNT_LOCKOUT_MAX_ENTRIES: "local" backend 最多記錄幾個 key
+DEFAULT_BACKEND = "local"
+DEFAULT_CACHE_ALIAS = "default"
+DEFAULT_THRESHOLD = 5
+DEFAULT_BASE_SECONDS = 30
+DEFAULT_MAX_SECONDS = 60 * 60
+DEFAULT_RESET_SECONDS = 60 * 60
+DEFAULT_MAX_ENTRIES = 100000
+
+
+def account_key(username):
+    return "account:" + username.strip().lower()
+
+
+def token_key(url_token):
+    return "token:" + url_token
+
+
+class LocalLockoutBackend(object):
+    # 單機用的 backend, 用 OrderedDict 做一個有上限的 LRU
+    # 超過 max_entries 的時候把最久沒有被碰到的 key 丟掉, 所以 memory 是有上限的
+    # 每個 entry 是 [failures, locked_until, expire_at]
+    #
+    # 注意: 計數只存在這個 process 裡, gunicorn 開多個 worker 時每個 worker 各算各的
+    # 這種情況要改用 CacheLockoutBackend
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def increment(self, key, timeout):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                entry = [0, 0, 0]
+                self._entries[key] = entry
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            entry[0] += 1
+            entry[2] = max(entry[2], time.time() + timeout)
+            return entry[0]
+
+    def locked_until(self, key):
+        with self._lock:
+            entry = self._get_entry(key)
+            return entry[1] if entry else 0
+
+    def lock(self, key, locked_until, timeout):
+        with self._lock:
+            entry = self._get_entry(key)
+            if entry is None:
+                return
+            entry[1] = max(entry[1], locked_until)
+            entry[2] = max(entry[2], time.time() + timeout)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class CacheLockoutBackend(object):
+    # 多台機器 (或多個 worker) 的時候用 Django cache (memcached, redis ...) 共用失敗次數
+    # 失敗次數用 cache.add + cache.incr 計算, 這兩個在 memcached, redis 上都是 atomic 的
+    # 同時有很多人在猜密碼的時候也不會少算
+    # 注意: memcached 的 incr 不會延長 timeout, 所以次數是從第一次失敗開始算 reset_seconds
+
+    failures_prefix = "lockout:failures:"
+    locked_prefix = "lockout:locked:"
+
+    def __init__(self, cache_alias):
+        self.cache = caches[cache_alias]
+
+    def _cache_key(self, prefix, key):
+        # username 可能有空白或是太長, memcached 不接受, 所以 hash 過再當 key
+        return prefix + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def increment(self, key, timeout):
+        cache_key = self._cache_key(self.failures_prefix, key)
+        self.cache.add(cache_key, 0, timeout)
+        try:
+            return self.cache.incr(cache_key)
+        except ValueError:
+            # add 跟 incr 之間 key 剛好過期了
+            self.cache.add(cache_key, 1, timeout)
+            return 1
+
+    def locked_until(self, key):
+        return self.cache.get(self._cache_key(self.locked_prefix, key), 0)
+
+    def lock(self, key, locked_until, timeout):
+        self.cache.set(self._cache_key(self.locked_prefix, key), locked_until, timeout)
+
+    def delete(self, key):
+        self.cache.delete_many([
+            self._cache_key(self.failures_prefix, key),
+            self._cache_key(self.locked_prefix, key),
+        ])
+
+
+class FailureTracker(object):
+    # 記錄每個 key (帳號或是 reset password token) 連續失敗的次數
+    # 失敗 threshold 次之後開始鎖定, 鎖定時間是 base_seconds * 2 ^ (failures - threshold)
+    # view 應該在做任何 DB 查詢或是 password hashing 之前先呼叫 locked_for
+
+    def __init__(self, backend, threshold, base_seconds, max_seconds, reset_seconds):
+        self.backend = backend
+        self.threshold = threshold
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.reset_seconds = reset_seconds
+
+    def locked_for(self, key):
+        # 回傳還要鎖定幾秒, 0 代表沒有被鎖定
+        remaining = self.backend.locked_until(key) - time.time()
+        return int(remaining) + 1 if remaining > 0 else 0
+
+    def record_failure(self, key):
+        failures = self.backend.increment(key, self.reset_seconds)
+        if failures < self.threshold:
+            return 0
+
+        exponent = min(failures - self.threshold, 32)
+        lock_seconds = min(self.base_seconds * 2 ** exponent, self.max_seconds)
+        self.backend.lock(key, time.time() + lock_seconds,
+                          max(lock_seconds, self.reset_seconds))
+        return lock_seconds
+
+    def reset(self, key):
+        self.backend.delete(key)
+
+
+def build_failure_tracker():
+    backend_name = getattr(settings, "ACCOUNT_LOCKOUT_BACKEND", DEFAULT_BACKEND)
+    if backend_name == "cache":
+        backend = CacheLockoutBackend(
+            getattr(settings, "ACCOUNT_LOCKOUT_CACHE_ALIAS", DEFAULT_CACHE_ALIAS))
+    else:
+        backend = LocalLockoutBackend(
+            getattr(settings, "ACCOUNT_LOCKOUT_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+
+    return FailureTracker(
+        backend,
+        threshold=getattr(settings, "ACCOUNT_LOCKOUT_THRESHOLD", DEFAULT_THRESHOLD),
+        base_seconds=getattr(settings, "ACCOUNT_LOCKOUT_BASE_SECONDS", DEFAULT_BASE_SECONDS),
+        max_seconds=getattr(settings, "ACCOUNT_LOCKOUT_MAX_SECONDS", DEFAULT_MAX_SECONDS),
+        reset_seconds=getattr(settings, "ACCOUNT_LOCKOUT_RESET_SECONDS", DEFAULT_RESET_SECONDS),
+    )
+
+
+failure_tracker = build_failure_tracker()
@@ -0,0 +1,75 @@
+import glob
+import json
+
+from django.core.management.base import BaseCommand
+
+from account.events import auth_event_log, log_file_pattern
+from account.models import AuthEvent
+
+
+class Command(BaseCommand):
+    # 查詢某個使用者最近的驗證事件
+    # 使用方式: ./manage.py auth_events someone@example.com --limit 20
+    help = "Show recent authentication events of a user"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("--limit", type=int, default=20)
+        parser.add_argument("--type", dest="event_type", default=None,
+                            help="only show this event type, e.g. login_failed")
+
+    def handle(self, *args, **options):
+        username = options["username"]
+        limit = options["limit"]
+        event_type = options["event_type"]
+
+        if auth_event_log.sink == "jsonl":
+            recent_events = self._read_jsonl(username, event_type, limit)
+        else:
+            recent_events = self._read_db(username, event_type, limit)
+
+        if not recent_events:
+            self.stdout.write("No events for {}".format(username))
+            return
+
+        for event in recent_events:
+            self.stdout.write("{created_time}  {event_type:<24} {ip_address}".format(**event))
+
+    def _read_db(self, username, event_type, limit):
+        queryset = AuthEvent.objects.filter(username=username)
+        if event_type:
+            queryset = queryset.filter(event_type=event_type)
+
+        return [
+            {
+                "created_time": event.created_time.isoformat(),
+                "event_type": event.event_type,
+                "ip_address": event.ip_address or "-",
+            }
+            for event in queryset[:limit]
+        ]
+
+    def _read_jsonl(self, username, event_type, limit):
+        # 每個 process 都有自己的檔案 (含 rotation 的 backup), 全部讀完再依時間排序
+        recent_events = []
+        for path in glob.glob(log_file_pattern(auth_event_log.log_file)):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # 寫到一半的行, 直接略過
+                        continue
+                    if not isinstance(event, dict) or "created_time" not in event:
+                        continue
+
+                    if event.get("username") != username:
+                        continue
+                    if event_type and event.get("event_type") != event_type:
+                        continue
+                    event.setdefault("event_type", "-")
+                    event["ip_address"] = event.get("ip_address") or "-"
+                    recent_events.append(event)
+
+        recent_events.sort(key=lambda event: event["created_time"], reverse=True)
+        return recent_events[:limit]
@@ -0,0 +1,86 @@
+import time
+from importlib import import_module
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import connections, router
+from django.test.utils import CaptureQueriesContext
+
+from account.session_backend import write_behind_queue
+
+ENGINES = (
+    "django.contrib.sessions.backends.db",
+    "django.contrib.sessions.backends.cache",
+    "django.contrib.sessions.backends.cached_db",
+    "account.session_backend",
+)
+
+
+class Command(BaseCommand):
+    # 比較不同 session engine 的讀取延遲，以及修改 session 時對 DB 的寫入次數
+    # 模擬每個 request 都建一個新的 SessionStore, 就跟 SessionMiddleware 一樣
+    # 使用方式: ./manage.py bench_sessions --sessions 200 --requests 20
+    #
+    # 注意: 會在目前設定的 DB 和 cache 裡面建立測試用的 session, 結束時會刪掉
+    help = "Benchmark session read latency and DB writes per session engine"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sessions", type=int, default=200,
+                            help="number of sessions to create")
+        parser.add_argument("--requests", type=int, default=20,
+                            help="requests (one read + one modify) per session")
+
+    def handle(self, *args, **options):
+        number_of_sessions = options["sessions"]
+        number_of_requests = options["requests"]
+
+        self.stdout.write("{:<45} {:>12} {:>12} {:>10}".format(
+            "engine", "read avg ms", "save avg ms", "DB writes"))
+
+        for engine in ENGINES:
+            store_class = import_module(engine).SessionStore
+            read_ms, save_ms, db_writes = self._run(
+                store_class, number_of_sessions, number_of_requests)
+            self.stdout.write("{:<45} {:>12.4f} {:>12.4f} {:>10}".format(
+                engine, read_ms, save_ms, db_writes))
+
+    def _run(self, store_class, number_of_sessions, number_of_requests):
+        session_keys = []
+        for i in range(number_of_sessions):
+            session = store_class()
+            session["_bench"] = i
+            session.create()
+            session_keys.append(session.session_key)
+
+        using = router.db_for_write(Session)
+        rows_written_before = write_behind_queue.rows_written
+
+        read_seconds = 0.0
+        save_seconds = 0.0
+        with CaptureQueriesContext(connections[using]) as queries:
+            for n in range(number_of_requests):
+                for session_key in session_keys:
+                    start_time = time.time()
+                    session = store_class(session_key)
+                    session.load()
+                    read_seconds += time.time() - start_time
+
+                    start_time = time.time()
+                    session["_bench_request"] = n
+                    session.save()
+                    save_seconds += time.time() - start_time
+
+        # write-behind 是在 background thread 寫的, 不會被 CaptureQueriesContext 抓到
+        # 所以另外用 rows_written 來算
+        write_behind_queue.flush()
+        db_writes = len([
+            query for query in queries.captured_queries
+            if query["sql"].lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE"))
+        ])
+        db_writes += write_behind_queue.rows_written - rows_written_before
+
+        for session_key in session_keys:
+            store_class(session_key).delete()
+
+        total = number_of_sessions * number_of_requests
+        return read_seconds * 1000 / total, save_seconds * 1000 / total, db_writes
@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# 在新的 process 裡面載入 demo.wsgi, 量 import 時間跟第一個 request 的時間
+# 每次都要是新的 process, 不然 module 已經被 import 過就不是 cold start 了
+WORKER_SCRIPT = """
+import json, os, sys, time
+from wsgiref.util import setup_testing_defaults
+
+start_time = time.time()
+from demo.wsgi import application
+startup = time.time() - start_time
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+first_request = {}
+for path in sys.argv[1:]:
+    environ = {"PATH_INFO": path}
+    setup_testing_defaults(environ)
+    start_time = time.time()
+    response = application(environ, start_response)
+    b"".join(response)
+    response.close()
+    first_request[path] = time.time() - start_time
+
+print(json.dumps({"startup": startup, "first_request": first_request}))
+"""
+
+DEFAULT_PATHS = ("/accounts/login/", "/accounts/register", "/accounts/info/")
+
+
+class Command(BaseCommand):
+    # 比較有沒有 warmup 時，每個 worker 第一個 request 的延遲
+    # 使用方式: ./manage.py bench_warmup --rounds 5
+    help = "Benchmark cold vs warm first-request latency of demo.wsgi"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rounds", type=int, default=5)
+        parser.add_argument("paths", nargs="*", default=list(DEFAULT_PATHS))
+
+    def handle(self, *args, **options):
+        rounds = options["rounds"]
+        paths = options["paths"]
+
+        self.stdout.write("{:<8} {:<24} {:>12}".format("mode", "step", "avg ms"))
+        for mode, warmup_flag in (("cold", "0"), ("warm", "1")):
+            results = [self._run_worker(warmup_flag, paths) for _ in range(rounds)]
+
+            startup = sum(result["startup"] for result in results) / rounds
+            self.stdout.write("{:<8} {:<24} {:>12.2f}".format(mode, "startup", startup * 1000))
+            for path in paths:
+                latency = sum(result["first_request"][path] for result in results) / rounds
+                self.stdout.write("{:<8} {:<24} {:>12.2f}".format(mode, path, latency * 1000))
+
+    def _run_worker(self, warmup_flag, paths):
+        env = dict(os.environ, DJANGO_WARMUP=warmup_flag,
+                   DJANGO_SETTINGS_MODULE=os.environ.get(
+                       "DJANGO_SETTINGS_MODULE", "demo.settings"))
+        output = subprocess.check_output(
+            [sys.executable, "-c", WORKER_SCRIPT] + list(paths),
+            cwd=settings.BASE_DIR, env=env)
+
+        return json.loads(output.decode("utf-8").strip().splitlines()[-1])
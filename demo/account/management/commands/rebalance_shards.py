@@ -0,0 +1,142 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from account.models import ShardDirectory, UserProfile
+from account.sharding import get_shards, is_email, shard_for_email
+
+
+class Command(BaseCommand):
+    # 調整 ACCOUNT_SHARDS 之後, 把使用者搬到 email hash 對應的 shard
+    # 使用方式: ./manage.py rebalance_shards --dry-run
+    #
+    # 1. 先把每個 shard 上還沒登記的使用者登記進 directory
+    #    每次升級或是開啟 sharding 之後都要執行 (--backfill-only)
+    #    --prune 會清掉沒有對應 user 的記錄, 因為可能刪到正在註冊中的使用者, 請在停機維護時執行
+    # 2. 再把 directory 裡 shard 不對的使用者搬過去
+    #
+    # Oauth 使用者固定留在 default, 不會被搬動
+    # 搬家時只會複製 User 與 UserProfile, 舊的 reset password 連結會失效, 重新申請即可
+    # 中途失敗的話直接重跑就好, 已經搬過去的使用者會被略過
+    help = "Register existing users in the shard directory and move users to their shard"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", default=False,
+                            help="only print what would be done")
+        parser.add_argument("--backfill-only", action="store_true", default=False,
+                            help="register unknown users but do not move anyone")
+        parser.add_argument("--prune", action="store_true", default=False,
+                            help="remove directory entries that have no user")
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        shards = get_shards()
+
+        registered = self._backfill(shards, dry_run, options["prune"])
+        self.stdout.write("registered {} users in the directory".format(registered))
+        if options["backfill_only"]:
+            return
+
+        moved = 0
+        for entry in ShardDirectory.objects.order_by("id").iterator():
+            if not is_email(entry.username):
+                continue
+
+            target = shard_for_email(entry.username, shards)
+            if target == entry.shard:
+                continue
+
+            self.stdout.write("{}: {} -> {}".format(entry.username, entry.shard, target))
+            if dry_run or self._move(entry, target):
+                moved += 1
+
+        self.stdout.write("moved {} users".format(moved))
+
+    def _backfill(self, shards, dry_run, prune):
+        directory = {
+            entry_id: (username, shard)
+            for entry_id, username, shard in ShardDirectory.objects.values_list(
+                "id", "username", "shard")
+        }
+
+        registered = 0
+        existing = set()
+        for shard in shards:
+            users = User.objects.using(shard).values_list("id", "username").order_by("id")
+            for user_id, username in users.iterator():
+                existing.add((user_id, shard))
+                if user_id in directory:
+                    if directory[user_id] != (username, shard):
+                        # 還沒登記就建立的 user 跟別人拿到同一個 id, 只能手動處理
+                        self.stderr.write("user {} ({}) on {} conflicts with directory entry {}".format(
+                            user_id, username, shard, directory[user_id]))
+                    continue
+
+                if not dry_run:
+                    ShardDirectory.objects.create(id=user_id, username=username, shard=shard)
+                directory[user_id] = (username, shard)
+                registered += 1
+
+        # 建立 user 失敗留下來的記錄, 不清掉的話這個 username 就不能再註冊
+        orphan_ids = [
+            entry_id for entry_id, (username, shard) in directory.items()
+            if (entry_id, shard) not in existing
+        ]
+        if prune and orphan_ids:
+            self.stdout.write("removing {} directory entries without a user".format(len(orphan_ids)))
+            if not dry_run:
+                ShardDirectory.objects.filter(id__in=orphan_ids).delete()
+
+        if registered and not dry_run:
+            self._reset_directory_sequence()
+
+        return registered
+
+    def _reset_directory_sequence(self):
+        # 登記的時候有指定 id, postgres 之類的 sequence 不會跟著前進, 要手動調整
+        # 不然之後分配的 id 會跟已經登記的 user 重複
+        connection = connections[DEFAULT_DB_ALIAS]
+        statements = connection.ops.sequence_reset_sql(no_style(), [ShardDirectory])
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def _move(self, entry, target):
+        source = entry.shard
+        try:
+            user = User.objects.using(source).get(pk=entry.id)
+        except User.DoesNotExist:
+            # 上一次搬到一半, user 已經在 target 上了
+            if User.objects.using(target).filter(pk=entry.id).exists():
+                entry.shard = target
+                entry.save(update_fields=["shard"])
+                return True
+
+            self.stderr.write("{}: user {} not found on {}".format(
+                entry.username, entry.id, source))
+            return False
+
+        if user.social_auth.exists():
+            return False
+
+        profile = UserProfile.objects.using(source).filter(user_id=user.pk).first()
+
+        with transaction.atomic(using=target):
+            if not User.objects.using(target).filter(pk=user.pk).exists():
+                # 建立 user 的時候 create_profile signal 會在 target 上建立空的 profile
+                user.save(using=target, force_insert=True)
+
+            if profile is not None:
+                UserProfile.objects.using(target).filter(user_id=user.pk).update(
+                    nickname=profile.nickname,
+                    contact_email=profile.contact_email,
+                    self_introduction=profile.self_introduction,
+                )
+
+        # 先改 directory 再刪除舊的資料, 中途失敗也不會找不到使用者
+        entry.shard = target
+        entry.save(update_fields=["shard"])
+        User.objects.using(source).filter(pk=user.pk).delete()
+
+        return True
@@ -1,9 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
 
+from .sharding import is_sharded, register_user
+
 # Create your models here.
 class UserProfile(models.Model):
     user = models.OneToOneField(User)
@@ -23,8 +25,39 @@ class ResetPasswordToken(models.Model):
     expire_time = models.DateTimeField(auto_now_add=True)
 
 
+class AuthEvent(models.Model):
+    # 這裡不用 ForeignKey 指向 User, 因為登入失敗的時候不一定有對應的 user
+    # 而且 event 是由 background thread 批次寫入的，不希望被 user 的刪除牽動
+    username = models.CharField(max_length=150, db_index=True)
+    event_type = models.CharField(max_length=32)
+    ip_address = models.GenericIPAddressField(null=True, blank=True)
+    created_time = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ('-created_time',)
+
+
+class ShardDirectory(models.Model):
+    # username -> shard 的對照表, 永遠存在 default DB (見 account.routers)
+    # id 同時也是 user 在 shard 上的 id, 確保不同 shard 的 user id 不會重複
+    username = models.CharField(max_length=150, unique=True)
+    shard = models.CharField(max_length=64)
+
+
+@receiver(pre_save, sender=User)
+def allocate_user_id(sender, instance=None, raw=False, using=None, **kwargs):
+    # sharding 的時候所有新的 user 都要先在 directory 拿到 id
+    # 包含 createsuperuser, admin, Oauth 的 create_user, 否則 id 會跟其他 shard 的 user 重複
+    # username 已經在 directory 裡的話會丟出 IntegrityError
+    if raw or instance.pk is not None or not is_sharded():
+        return
+
+    instance.pk = register_user(instance.get_username(), using).id
+
+
 @receiver(post_save, sender=User)
-def create_profile(sender, instance=None, created=False, **kwargs):
+def create_profile(sender, instance=None, created=False, using=None, **kwargs):
+    # profile 要跟 user 建立在同一個 shard 上
     if created:
-        UserProfile.objects.create(user=instance)
+        UserProfile.objects.using(using).create(user=instance)
 
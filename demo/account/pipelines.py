@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User
 from .models import UserProfile
+from .sharding import shard_for_username
 
 # 這個 pipeline 只有在處理 Oauth Account 的時候會用到
 def save_profile(backend, *args, **kwargs):
@@ -10,7 +11,7 @@ def save_profile(backend, *args, **kwargs):
     fullname = details.get('fullname')
 
     # clean email to disable find password
-    user = User.objects.get(username=username)
+    user = User.objects.using(shard_for_username(username)).get(username=username)
     
     # init user profile
     profile = user.userprofile
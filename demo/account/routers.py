@@ -0,0 +1,32 @@
+from django.db import DEFAULT_DB_ALIAS
+
+# 這些 model 只存在 default DB
+DEFAULT_ONLY_MODELS = ("sharddirectory", "authevent")
+
+
+class AccountShardRouter(object):
+    # User, UserProfile, ResetPasswordToken 要去哪個 shard 是由 view 用 .using() 決定的
+    # (見 account.sharding), 這裡不用處理:
+    # router 都回傳 None 的時候, Django 會用 instance 所在的 DB, 所以
+    # user.userprofile, user.save() 這些操作都會留在同一個 shard 上
+    #
+    # router 只負責把 directory 跟 auth event 固定在 default
+
+    def _is_default_only(self, model):
+        return (model._meta.app_label == "account"
+                and model._meta.model_name in DEFAULT_ONLY_MODELS)
+
+    def db_for_read(self, model, **hints):
+        if self._is_default_only(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._is_default_only(model):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == "account" and model_name in DEFAULT_ONLY_MODELS:
+            return db == DEFAULT_DB_ALIAS
+        return None
@@ -0,0 +1,257 @@
+import atexit
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.sessions.backends import cached_db
+from django.contrib.sessions.backends.base import UpdateError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connections, router, transaction
+
+logger = logging.getLogger(__name__)
+
+# Hybrid session engine, 使用方式: SESSION_ENGINE = "account.session_backend"
+#
+# 讀取: process 內的 LRU -> SESSION_CACHE_ALIAS 的共用 cache -> DB
+# 寫入: 新建 session 直接寫 DB (需要靠 DB 檢查 session_key 有沒有重複)
+#       之後的修改只寫 cache 跟 LRU, DB 由 background thread 批次寫入 (write-behind)
+#       刪除 (logout) 一律同步寫 DB, 並且在 cache 留下 tombstone
+#       之後的 save 看到 tombstone 就丟出 UpdateError, 不會把已經登出的 session 寫回 cache
+#       LRU 命中的時候也會到 cache 檢查 tombstone, 所以在別的 worker 登出會馬上生效
+#       LRU 省下的是 session data 的傳輸跟 unpickle, tombstone 只是一個很小的 key
+#
+# SESSION_CACHE_ALIAS 一定要是多個 process 共用的 cache (memcached, redis ...)
+# 用 LocMemCache 的話, 每個 gunicorn worker 都有自己的 cache,
+# 在一個 worker 登出之後, 其他 worker 的 cache 裡 session 還是有效的, 所以啟動時直接擋掉
+#
+# 可以在 settings 裡面覆寫
+#   ACCOUNT_SESSION_LOCAL_MAX_ENTRIES: process 內 LRU 最多放幾個 session
+#   ACCOUNT_SESSION_LOCAL_TTL: LRU 裡的 session 最多放幾秒
+#       多個 process 之間 LRU 不會同步, 別的 worker 修改過的 session 在這段時間內可能讀到舊的資料
+#       (登出不受影響, 見上面的 tombstone)
+#   ACCOUNT_SESSION_FLUSH_INTERVAL: write-behind 多久寫一次 DB (秒)
+DEFAULT_LOCAL_MAX_ENTRIES = 10000
+DEFAULT_LOCAL_TTL = 2.0
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+LOCAL_CACHE_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+def check_shared_cache():
+    if settings.SESSION_ENGINE != __name__:
+        return
+
+    backend = settings.CACHES[settings.SESSION_CACHE_ALIAS]["BACKEND"]
+    if backend in LOCAL_CACHE_BACKENDS:
+        raise ImproperlyConfigured(
+            "{} needs a cache shared by all processes, but CACHES['{}'] uses {}".format(
+                __name__, settings.SESSION_CACHE_ALIAS, backend))
+
+
+class LocalSessionCache(object):
+    # process 內的 LRU, 每個 entry 是 (session_data, expire_at)
+    # 存進去跟拿出來都會 deepcopy, 避免 request 之間共用同一個 dict
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_key):
+        with self._lock:
+            entry = self._entries.get(session_key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self._entries[session_key]
+                return None
+            self._entries.move_to_end(session_key)
+            data = entry[0]
+        return copy.deepcopy(data)
+
+    def set(self, session_key, data, expiry_age):
+        expire_at = time.time() + min(self.ttl, expiry_age)
+        data = copy.deepcopy(data)
+        with self._lock:
+            self._entries[session_key] = (data, expire_at)
+            self._entries.move_to_end(session_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, session_key):
+        with self._lock:
+            self._entries.pop(session_key, None)
+
+    def __contains__(self, session_key):
+        return self.get(session_key) is not None
+
+
+class WriteBehindQueue(object):
+    # 同一個 session 在 flush 之前被修改很多次的話，只會寫最後一次
+    # flush 用 UPDATE 而不是 INSERT, 所以已經被刪除 (logout) 的 session 不會被寫回來
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.rows_written = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def put(self, model, session_key, session_data, expire_date):
+        with self._lock:
+            self._pending[session_key] = (model, session_data, expire_date)
+        self._ensure_thread()
+
+    def discard(self, session_key):
+        with self._lock:
+            self._pending.pop(session_key, None)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            try:
+                self._write(pending)
+            except DatabaseError:
+                # 例如 sqlite 的 database is locked, 放回 queue 等下一次 flush 再試
+                # 這段時間內又被修改的 session 以新的為準
+                logger.exception("failed to flush %d sessions, will retry", len(pending))
+                with self._lock:
+                    for session_key, row in pending.items():
+                        self._pending.setdefault(session_key, row)
+                return 0
+            finally:
+                if threading.current_thread() is self._thread:
+                    connections.close_all()
+
+            self.rows_written += len(pending)
+
+        return len(pending)
+
+    def _write(self, pending):
+        # 一個 batch 只 commit 一次
+        by_database = {}
+        for session_key, (model, session_data, expire_date) in pending.items():
+            using = router.db_for_write(model)
+            by_database.setdefault(using, []).append(
+                (model, session_key, session_data, expire_date))
+
+        for using, rows in by_database.items():
+            with transaction.atomic(using=using):
+                for model, session_key, session_data, expire_date in rows:
+                    model.objects.using(using).filter(session_key=session_key).update(
+                        session_data=session_data, expire_date=expire_date)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, name="session-write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+
+local_sessions = LocalSessionCache(
+    getattr(settings, "ACCOUNT_SESSION_LOCAL_MAX_ENTRIES", DEFAULT_LOCAL_MAX_ENTRIES),
+    getattr(settings, "ACCOUNT_SESSION_LOCAL_TTL", DEFAULT_LOCAL_TTL),
+)
+write_behind_queue = WriteBehindQueue(
+    getattr(settings, "ACCOUNT_SESSION_FLUSH_INTERVAL", DEFAULT_FLUSH_INTERVAL))
+atexit.register(write_behind_queue.flush)
+check_shared_cache()
+
+TOMBSTONE_KEY_PREFIX = "account.session_backend.deleted:"
+
+
+class SessionStore(cached_db.SessionStore):
+
+    def _tombstone_key(self, session_key):
+        return TOMBSTONE_KEY_PREFIX + session_key
+
+    def _is_deleted(self, session_key):
+        return self._cache.get(self._tombstone_key(session_key)) is not None
+
+    def load(self):
+        session_key = self.session_key
+        if session_key:
+            data = local_sessions.get(session_key)
+            if data is not None:
+                # 別的 worker 登出的時候清不到這個 process 的 LRU, 只能靠 tombstone 發現
+                if not self._is_deleted(session_key):
+                    return data
+                local_sessions.delete(session_key)
+
+        data = super(SessionStore, self).load()
+        # super().load() 找不到 session 的時候會把 _session_key 設成 None
+        # 這時候 _session_cache 還沒設定，所以 expiry 要直接從 data 拿, 不然會遞迴呼叫 load()
+        if self.session_key:
+            expiry_age = self.get_expiry_age(expiry=data.get("_session_expiry"))
+            local_sessions.set(self.session_key, data, expiry_age)
+        return data
+
+    def exists(self, session_key):
+        if session_key and session_key in local_sessions:
+            if not self._is_deleted(session_key):
+                return True
+            local_sessions.delete(session_key)
+        return super(SessionStore, self).exists(session_key)
+
+    def save(self, must_create=False):
+        if self.session_key is None or must_create:
+            # 新建的 session 一定要同步寫 DB, 才能發現 session_key 重複
+            super(SessionStore, self).save(must_create)
+            if self.session_key:
+                local_sessions.set(self.session_key, self._session, self.get_expiry_age())
+            return
+
+        # 跟 cached_db 一樣, session 已經被刪除 (例如同時在別的 request 登出) 就丟出 UpdateError
+        # SessionMiddleware 會把它轉成 SuspiciousOperation
+        session_key = self.session_key
+        if self._is_deleted(session_key):
+            raise UpdateError
+
+        data = self._get_session()
+        expiry_age = self.get_expiry_age()
+        self._cache.set(self.cache_key, data, expiry_age)
+        local_sessions.set(session_key, data, expiry_age)
+        write_behind_queue.put(
+            self.model, session_key, self.encode(data), self.get_expiry_date())
+
+        # delete() 是先寫 tombstone 再清 cache, 如果上面寫入的時候剛好被刪除,
+        # 這裡一定看得到 tombstone, 要把剛剛寫進去的東西清掉
+        if self._is_deleted(session_key):
+            write_behind_queue.discard(session_key)
+            local_sessions.delete(session_key)
+            self._cache.delete(self.cache_key)
+            raise UpdateError
+
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+
+        # tombstone 一定要在清 cache 之前寫入, 見 save()
+        self._cache.set(self._tombstone_key(session_key), True, settings.SESSION_COOKIE_AGE)
+        write_behind_queue.discard(session_key)
+        local_sessions.delete(session_key)
+        super(SessionStore, self).delete(session_key)
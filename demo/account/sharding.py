@@ -0,0 +1,119 @@
+import hashlib
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import DEFAULT_DB_ALIAS
+
+# User, UserProfile, ResetPasswordToken 會依照 email 分散到 settings.ACCOUNT_SHARDS 裡的 DB
+#
+# ShardDirectory (永遠在 default DB) 記錄 username -> shard
+# ShardDirectory 的 id 同時也是 user 的 id, 所以每個 shard 上的 user id 都不會重複
+# (由 .models.allocate_user_id 在建立 user 之前分配)
+# session 裡只存 user id, 透過 directory 就知道要去哪個 shard 拿 user
+#
+# Oauth 使用者固定放在 default, 因為 social_django 的 table 都在 default, 而且 ForeignKey 到 User
+# django-oauth-toolkit 的 AccessToken 也一樣在 default, 所以 /token 的 password grant
+# 只支援 default 上的使用者, 其他 shard 上的使用者請用 /accounts/login/ 的 session 登入
+#
+# 只有一個 shard 的時候不會使用 directory, 所有的查詢都直接回傳 default
+
+
+def get_shards():
+    return list(getattr(settings, "ACCOUNT_SHARDS", [DEFAULT_DB_ALIAS]))
+
+
+def is_sharded():
+    return len(get_shards()) > 1
+
+
+def normalize_email(email):
+    return email.strip().lower()
+
+
+def is_email(username):
+    try:
+        validate_email(username)
+    except ValidationError:
+        return False
+    return True
+
+
+def jump_hash(key, number_of_buckets):
+    # Jump consistent hash (Lamping & Veach)
+    # shard 數量從 N 變成 N+1 的時候, 只有大約 1/(N+1) 的使用者需要搬家
+    bucket, next_bucket = -1, 0
+    while next_bucket < number_of_buckets:
+        bucket = next_bucket
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        next_bucket = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for_email(email, shards=None):
+    shards = shards or get_shards()
+    if len(shards) == 1:
+        return shards[0]
+
+    digest = hashlib.md5(normalize_email(email).encode("utf-8")).digest()
+    key = int.from_bytes(digest[:8], "big")
+    return shards[jump_hash(key, len(shards))]
+
+
+def shard_for_username(username):
+    # 已經註冊的使用者以 directory 為準 (可能被 rebalance 搬過, 或是 Oauth 使用者)
+    # 還沒註冊的 email 就用 hash 算出來
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+
+    from .models import ShardDirectory
+
+    shard = ShardDirectory.objects.filter(username=username) \
+        .values_list("shard", flat=True).first()
+    if shard is not None:
+        return shard
+
+    return shard_for_email(username) if is_email(username) else DEFAULT_DB_ALIAS
+
+
+def directory_entry_for_user_id(user_id):
+    # 回傳 (shard, username), username 是 None 代表 directory 裡沒有這個 id
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS, None
+
+    from .models import ShardDirectory
+
+    entry = ShardDirectory.objects.filter(pk=user_id) \
+        .values_list("shard", "username").first()
+    return entry or (DEFAULT_DB_ALIAS, None)
+
+
+def group_by_shard(user_ids=(), usernames=()):
+    # 批次查詢用, 回傳 {shard: (user_ids, usernames)}, directory 各只查一次
+    if not is_sharded():
+        return {DEFAULT_DB_ALIAS: (list(user_ids), list(usernames))}
+
+    from .models import ShardDirectory
+
+    grouped = defaultdict(lambda: ([], []))
+
+    shard_by_id = dict(ShardDirectory.objects.filter(pk__in=user_ids)
+                       .values_list("id", "shard"))
+    for user_id in user_ids:
+        grouped[shard_by_id.get(user_id, DEFAULT_DB_ALIAS)][0].append(user_id)
+
+    shard_by_username = dict(ShardDirectory.objects.filter(username__in=usernames)
+                             .values_list("username", "shard"))
+    for username in usernames:
+        grouped[shard_by_username.get(username, DEFAULT_DB_ALIAS)][1].append(username)
+
+    return dict(grouped)
+
+
+def register_user(username, shard):
+    # 在 directory 拿到 user id, 之後再到 shard 上用這個 id 建立 user
+    # username 重複的話會丟出 IntegrityError
+    from .models import ShardDirectory
+
+    return ShardDirectory.objects.create(username=username, shard=shard)
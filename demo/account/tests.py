@@ -1,3 +1,674 @@
-from django.test import TestCase
+import datetime
+import fnmatch
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.base import UpdateError
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from demo.warmup import WARMUP_STEPS, warmup
+
+from . import events
+from .backends import ShardedModelBackend
+from .events import AuthEventLog, auth_event_log, log_file_pattern, process_log_file
+from .lockout import (
+    CacheLockoutBackend,
+    FailureTracker,
+    LocalLockoutBackend,
+    failure_tracker,
+    token_key,
+)
+from .models import AuthEvent, ResetPasswordToken, ShardDirectory, UserProfile
+from .pipelines import save_profile
+from .session_backend import (
+    SessionStore,
+    check_shared_cache,
+    local_sessions,
+    write_behind_queue,
+)
+from .sharding import shard_for_email
+from .utils import BULK_LOOKUP_MAX_SIZE
+
+# 執行方式: ./manage.py test account --settings=demo.test_settings
+
+
+def pause_auth_event_log(test):
+    # view 會把事件記到 auth_event_log, 測試時不要啟動 background thread
+    # 結束時也要清空 buffer, 不然 atexit 的 flush 會在測試 DB 刪掉之後寫進真正的 DB
+    patcher = mock.patch.object(auth_event_log, "_ensure_thread")
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    auth_event_log._buffer.clear()
+    test.addCleanup(auth_event_log._buffer.clear)
+
+
+class BulkProfileLookupTest(TestCase):
+    multi_db = True
+    url = "/accounts/profiles/bulk/"
+
+    def setUp(self):
+        self.staff = User.objects.create_superuser("admin", "admin@example.com", "secret123")
+        self.client.force_login(self.staff, backend="account.backends.ShardedModelBackend")
+
+    def lookup(self, payload):
+        return self.client.post(self.url, json.dumps(payload), content_type="application/json")
+
+    def test_returns_nicknames_by_id_and_email(self):
+        user = User.objects.create_user("bulk@example.com")
+        UserProfile.objects.using(user._state.db).filter(user=user).update(nickname="bulk")
+
+        response = self.lookup({"user_ids": [user.id, 999999],
+                                "emails": ["bulk@example.com", "missing@example.com"]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["ids"], {str(user.id): "bulk"})
+        self.assertEqual(response.data["emails"], {"bulk@example.com": "bulk"})
+        self.assertEqual(float(response["X-Batch-Latency-Ms"]), response.data["latency_ms"])
+
+    def test_rejects_non_list_and_empty_input(self):
+        for payload in ({"user_ids": 1}, {"emails": "bulk@example.com"}, {}, {"user_ids": []}):
+            self.assertEqual(self.lookup(payload).status_code, 422)
+
+    def test_rejects_too_many_keys(self):
+        half = BULK_LOOKUP_MAX_SIZE // 2
+        payload = {"user_ids": list(range(1, half + 2)),
+                   "emails": ["user{}@example.com".format(i) for i in range(half)]}
+        self.assertEqual(self.lookup(payload).status_code, 413)
+
+        payload["user_ids"].pop()
+        self.assertEqual(self.lookup(payload).status_code, 200)
+
+    def test_rejects_non_staff(self):
+        user = User.objects.create_user("plain@example.com")
+        self.client.force_login(user, backend="account.backends.ShardedModelBackend")
+        self.assertEqual(self.lookup({"user_ids": [user.id]}).status_code, 403)
+
+
+class AuthEventLogTest(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(AuthEventLog, "_ensure_thread")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+
+    def make_log(self, **kwargs):
+        log = AuthEventLog(flush_threshold=100, **kwargs)
+        self.addCleanup(lambda: log._file_handler and log._file_handler.close())
+        return log
+
+    def test_drops_events_when_buffer_is_full(self):
+        log = self.make_log(sink="db", buffer_size=2)
+        self.assertTrue(log.record("a@example.com", events.LOGIN))
+        self.assertTrue(log.record("a@example.com", events.LOGOUT))
+        self.assertFalse(log.record("a@example.com", events.LOGIN))
+        self.assertEqual(log.dropped, 1)
+
+        with self.assertLogs("account.events", "WARNING"):
+            self.assertEqual(log.flush(), 2)
+        self.assertEqual(log.dropped, 0)
+        self.assertTrue(log.record("a@example.com", events.LOGIN))
+
+    def test_flush_db_sink(self):
+        log = self.make_log(sink="db")
+        log.record("a@example.com", events.LOGIN_FAILED, "10.0.0.1")
+        log.record("b@example.com", events.SIGNUP)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(log.flush(), 2)
+        self.assertEqual(log.flush(), 0)
+
+        event = AuthEvent.objects.get(username="a@example.com")
+        self.assertEqual(event.event_type, events.LOGIN_FAILED)
+        self.assertEqual(event.ip_address, "10.0.0.1")
+        self.assertTrue(AuthEvent.objects.filter(username="b@example.com").exists())
+
+    def test_flush_jsonl_sink_writes_process_file(self):
+        log_file = os.path.join(self.log_dir, "auth_events.jsonl")
+        log = self.make_log(sink="jsonl", log_file=log_file)
+        log.record("a@example.com", events.LOGIN, "10.0.0.1")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(log.flush(), 1)
+
+        with open(process_log_file(log_file, os.getpid()), encoding="utf-8") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(lines[0]["username"], "a@example.com")
+        self.assertEqual(lines[0]["event_type"], events.LOGIN)
+        self.assertEqual(lines[0]["ip_address"], "10.0.0.1")
+
+    def test_process_log_file_and_pattern(self):
+        self.assertEqual(process_log_file("/var/log/auth_events.jsonl", 123),
+                         "/var/log/auth_events.123.jsonl")
+
+        pattern = log_file_pattern("/var/log/auth_events.jsonl")
+        self.assertTrue(fnmatch.fnmatch("/var/log/auth_events.123.jsonl", pattern))
+        self.assertTrue(fnmatch.fnmatch("/var/log/auth_events.123.jsonl.2", pattern))
+        self.assertFalse(fnmatch.fnmatch("/var/log/auth_events.jsonl", pattern))
+
+
+class AuthEventsCommandTest(TestCase):
+
+    def run_command(self, *args):
+        stdout = StringIO()
+        call_command("auth_events", *args, stdout=stdout)
+        return stdout.getvalue().splitlines()
+
+    def test_reads_db_newest_first(self):
+        now = timezone.now()
+        for minutes, event_type in ((2, events.LOGIN_FAILED), (1, events.LOGIN)):
+            AuthEvent.objects.create(username="a@example.com", event_type=event_type,
+                                     created_time=now - datetime.timedelta(minutes=minutes))
+        AuthEvent.objects.create(username="b@example.com", event_type=events.LOGIN,
+                                 created_time=now)
+
+        lines = self.run_command("a@example.com")
+        self.assertEqual(len(lines), 2)
+        self.assertIn(events.LOGIN, lines[0])
+        self.assertIn(events.LOGIN_FAILED, lines[1])
+
+        lines = self.run_command("a@example.com", "--type", events.LOGIN_FAILED, "--limit", "5")
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(self.run_command("c@example.com"), ["No events for c@example.com"])
+
+    def test_reads_every_process_file_and_skips_bad_lines(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        log_file = os.path.join(log_dir, "auth_events.jsonl")
+
+        def event(created_time, event_type):
+            return json.dumps({"username": "a@example.com", "event_type": event_type,
+                               "ip_address": None, "created_time": created_time})
+
+        with open(process_log_file(log_file, 100), "w", encoding="utf-8") as f:
+            f.write(event("2017-01-01T00:00:01", events.LOGIN_FAILED) + "\n")
+            f.write('{"username": "a@example.com", "event_ty\n')
+            f.write("[1, 2]\n")
+            f.write('{"username": "a@example.com"}\n')
+        with open(process_log_file(log_file, 200) + ".1", "w", encoding="utf-8") as f:
+            f.write(event("2017-01-01T00:00:03", events.LOGIN) + "\n")
+            f.write(event("2017-01-01T00:00:02", events.LOGOUT) + "\n")
+
+        with mock.patch.object(auth_event_log, "sink", "jsonl"), \
+                mock.patch.object(auth_event_log, "log_file", log_file):
+            lines = self.run_command("a@example.com")
+            filtered = self.run_command("a@example.com", "--type", events.LOGOUT)
+
+        self.assertEqual([line.split()[1] for line in lines],
+                         [events.LOGIN, events.LOGOUT, events.LOGIN_FAILED])
+        self.assertEqual(len(filtered), 1)
+
+
+class FailureTrackerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 1000000.0
+        patcher = mock.patch("account.lockout.time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.tracker = FailureTracker(
+            LocalLockoutBackend(max_entries=100),
+            threshold=3, base_seconds=10, max_seconds=60, reset_seconds=600)
+
+    def test_not_locked_below_threshold(self):
+        self.assertEqual(self.tracker.record_failure("account:a"), 0)
+        self.assertEqual(self.tracker.record_failure("account:a"), 0)
+        self.assertEqual(self.tracker.locked_for("account:a"), 0)
+
+    def test_locked_at_threshold(self):
+        for _ in range(3):
+            lock_seconds = self.tracker.record_failure("account:a")
+
+        self.assertEqual(lock_seconds, 10)
+        self.assertGreater(self.tracker.locked_for("account:a"), 0)
+        self.assertEqual(self.tracker.locked_for("account:b"), 0)
+
+    def test_lock_window_doubles_up_to_max(self):
+        lock_windows = [self.tracker.record_failure("account:a") for _ in range(7)]
+        self.assertEqual(lock_windows, [0, 0, 10, 20, 40, 60, 60])
+
+    def test_lock_expires(self):
+        for _ in range(3):
+            self.tracker.record_failure("account:a")
+
+        self.now += 11
+        self.assertEqual(self.tracker.locked_for("account:a"), 0)
+
+    def test_reset_clears_failures(self):
+        for _ in range(3):
+            self.tracker.record_failure("account:a")
+
+        self.tracker.reset("account:a")
+        self.assertEqual(self.tracker.locked_for("account:a"), 0)
+        self.assertEqual(self.tracker.record_failure("account:a"), 0)
+
+    def test_failures_forgotten_after_reset_seconds(self):
+        self.tracker.record_failure("account:a")
+        self.tracker.record_failure("account:a")
+
+        self.now += 601
+        self.assertEqual(self.tracker.record_failure("account:a"), 0)
+
+    def test_local_backend_is_bounded(self):
+        backend = LocalLockoutBackend(max_entries=2)
+        for key in ("a", "b", "c"):
+            backend.increment(key, 600)
+
+        self.assertEqual(len(backend._entries), 2)
+        self.assertNotIn("a", backend._entries)
+
+
+class CacheLockoutBackendTest(SimpleTestCase):
+
+    def setUp(self):
+        self.backend = CacheLockoutBackend("default")
+        self.backend.cache.clear()
+
+    def test_increment_counts_every_failure(self):
+        counts = [self.backend.increment("account:someone here", 600) for _ in range(5)]
+        self.assertEqual(counts, [1, 2, 3, 4, 5])
+
+    def test_lock_and_delete(self):
+        self.backend.increment("account:a", 600)
+        self.backend.lock("account:a", 12345.0, 600)
+        self.assertEqual(self.backend.locked_until("account:a"), 12345.0)
+
+        self.backend.delete("account:a")
+        self.assertEqual(self.backend.locked_until("account:a"), 0)
+        self.assertEqual(self.backend.increment("account:a", 600), 1)
+
+
+class LockoutViewTest(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        # 每個測試都用新的計數, 不要被其他測試影響
+        original_backend = failure_tracker.backend
+        failure_tracker.backend = LocalLockoutBackend(max_entries=1000)
+        self.addCleanup(setattr, failure_tracker, "backend", original_backend)
+        pause_auth_event_log(self)
+
+        self.user = User.objects.create_user(username="lock@example.com", password="secret123")
+
+    def login(self, password):
+        return self.client.post("/accounts/login/",
+                                {"username": "lock@example.com", "password": password})
+
+    def test_login_locked_after_threshold(self):
+        for _ in range(failure_tracker.threshold):
+            self.assertEqual(self.login("wrong123").status_code, 401)
+
+        with mock.patch("account.views.authenticate") as authenticate:
+            response = self.login("secret123")
+
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        # 被鎖定的時候不可以做 authenticate (password hashing)
+        self.assertFalse(authenticate.called)
+
+    def test_login_success_resets_failures(self):
+        for _ in range(failure_tracker.threshold - 1):
+            self.login("wrong123")
+
+        self.assertEqual(self.login("secret123").status_code, 302)
+        self.client.logout()
+
+        for _ in range(failure_tracker.threshold - 1):
+            self.assertEqual(self.login("wrong123").status_code, 401)
+
+    def test_reset_password_token_locked_after_threshold(self):
+        url_token = "a" * 64
+        tokens = ResetPasswordToken.objects.using(self.user._state.db)
+        tokens.create(user=self.user, dynamic_url=url_token, entry_token="abc123")
+        tokens.filter(user=self.user).update(
+            expire_time=timezone.now() + datetime.timedelta(minutes=10))
+
+        url = "/accounts/reset_password/{}/".format(url_token)
+        data = {"new_password": "newpass123", "confirm_new_password": "newpass123"}
+        for _ in range(failure_tracker.threshold):
+            response = self.client.post(url, dict(data, entry_token="zzzzzz"))
+            self.assertEqual(response.status_code, 400)
+
+        response = self.client.post(url, dict(data, entry_token="abc123"))
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(failure_tracker.locked_for(token_key(url_token)), 0)
+
+
+class HybridSessionStoreTest(TestCase):
+
+    def setUp(self):
+        # background thread 不要自己跑, 由測試呼叫 flush
+        patcher = mock.patch.object(write_behind_queue, "_ensure_thread")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.cache = caches[settings.SESSION_CACHE_ALIAS]
+        self.cache.clear()
+        local_sessions._entries.clear()
+        write_behind_queue._pending.clear()
+
+        self.session = SessionStore()
+        self.session["step"] = 1
+        self.session.create()
+        self.session_key = self.session.session_key
+
+    def db_data(self):
+        return Session.objects.get(session_key=self.session_key).get_decoded()
+
+    def test_create_is_written_to_db(self):
+        self.assertEqual(self.db_data(), {"step": 1})
+
+    def test_read_served_from_local_cache(self):
+        self.cache.clear()
+        with self.assertNumQueries(0):
+            data = SessionStore(self.session_key).load()
+        self.assertEqual(data, {"step": 1})
+
+    def test_read_falls_back_to_db(self):
+        self.cache.clear()
+        local_sessions._entries.clear()
+        self.assertEqual(SessionStore(self.session_key).load(), {"step": 1})
+
+    def test_save_is_written_behind(self):
+        session = SessionStore(self.session_key)
+        session["step"] = 2
+        with self.assertNumQueries(0):
+            session.save()
+
+        self.assertEqual(SessionStore(self.session_key).load(), {"step": 2})
+        self.assertEqual(self.db_data(), {"step": 1})
+
+        self.assertEqual(write_behind_queue.flush(), 1)
+        self.assertEqual(self.db_data(), {"step": 2})
+
+    def test_flush_keeps_only_latest_write(self):
+        for step in (2, 3, 4):
+            session = SessionStore(self.session_key)
+            session["step"] = step
+            session.save()
+
+        self.assertEqual(write_behind_queue.flush(), 1)
+        self.assertEqual(self.db_data(), {"step": 4})
+
+    def test_failed_flush_is_retried(self):
+        session = SessionStore(self.session_key)
+        session["step"] = 2
+        session.save()
+
+        with mock.patch.object(write_behind_queue, "_write", side_effect=DatabaseError), \
+                self.assertLogs("account.session_backend", "ERROR"):
+            self.assertEqual(write_behind_queue.flush(), 0)
+
+        self.assertEqual(write_behind_queue.flush(), 1)
+        self.assertEqual(self.db_data(), {"step": 2})
+
+    def test_save_after_delete_raises(self):
+        session = SessionStore(self.session_key)
+        self.assertEqual(session["step"], 1)
+
+        SessionStore(self.session_key).delete()
+
+        session["step"] = 2
+        with self.assertRaises(UpdateError):
+            session.save()
+
+        write_behind_queue.flush()
+        self.assertFalse(Session.objects.filter(session_key=self.session_key).exists())
+        self.assertEqual(SessionStore(self.session_key).load(), {})
+
+    def test_delete_on_other_process_ignores_local_cache(self):
+        # 模擬在別的 worker 登出: DB, cache 被清掉, 但是這個 process 的 LRU 還留著
+        self.assertIsNotNone(local_sessions.get(self.session_key))
+        with mock.patch.object(local_sessions, "delete"):
+            SessionStore(self.session_key).delete()
+        self.assertIsNotNone(local_sessions.get(self.session_key))
+
+        self.assertFalse(SessionStore().exists(self.session_key))
+        self.assertEqual(SessionStore(self.session_key).load(), {})
+        self.assertIsNone(local_sessions.get(self.session_key))
+
+    def test_delete_during_save_does_not_resurrect(self):
+        # 模擬 save 寫 cache 的時候剛好有另一個 request 登出
+        session = SessionStore(self.session_key)
+        session["step"] = 2
+        original_put = write_behind_queue.put
+
+        def put_then_delete(*args, **kwargs):
+            original_put(*args, **kwargs)
+            SessionStore(self.session_key).delete()
+
+        with mock.patch.object(write_behind_queue, "put", side_effect=put_then_delete):
+            with self.assertRaises(UpdateError):
+                session.save()
+
+        self.assertIsNone(self.cache.get(session.cache_key))
+        self.assertIsNone(local_sessions.get(self.session_key))
+        self.assertEqual(write_behind_queue.flush(), 0)
+        self.assertEqual(SessionStore(self.session_key).load(), {})
+
+    def test_rejects_process_local_cache(self):
+        with override_settings(SESSION_ENGINE="account.session_backend"):
+            with self.assertRaises(ImproperlyConfigured):
+                check_shared_cache()
+
+        shared_cache = {"default": {
+            "BACKEND": "django.core.cache.backends.memcached.MemcachedCache",
+            "LOCATION": "127.0.0.1:11211",
+        }}
+        with override_settings(SESSION_ENGINE="account.session_backend", CACHES=shared_cache):
+            check_shared_cache()
+
+
+def email_on_shard(shard, prefix="user"):
+    # 找一個 hash 之後會落在指定 shard 的 email
+    for i in range(1000):
+        email = "{}{}@example.com".format(prefix, i)
+        if shard_for_email(email) == shard:
+            return email
+    raise AssertionError("no email hashes to {}".format(shard))
+
+
+class ShardingTest(TestCase):
+    multi_db = True
+    password = "secret123"
+
+    def setUp(self):
+        original_backend = failure_tracker.backend
+        failure_tracker.backend = LocalLockoutBackend(max_entries=1000)
+        self.addCleanup(setattr, failure_tracker, "backend", original_backend)
+        pause_auth_event_log(self)
+
+    def signup(self, email):
+        return self.client.post("/accounts/register", {
+            "username": email,
+            "password": self.password,
+            "confirm_password": self.password,
+        })
+
+    def test_signup_creates_user_on_hashed_shard(self):
+        for shard, other in (("default", "shard_1"), ("shard_1", "default")):
+            email = email_on_shard(shard)
+            self.assertEqual(self.signup(email).status_code, 302)
+            self.client.logout()
+
+            user = User.objects.using(shard).get(username=email)
+            self.assertFalse(User.objects.using(other).filter(username=email).exists())
+            self.assertEqual(ShardDirectory.objects.get(username=email).shard, shard)
+            self.assertEqual(ShardDirectory.objects.get(username=email).id, user.id)
+
+            profile = UserProfile.objects.using(shard).get(user_id=user.id)
+            self.assertEqual(profile.nickname, email.split("@")[0])
+
+    def test_user_ids_unique_across_shards(self):
+        first = User.objects.db_manager("default").create_user(email_on_shard("default"))
+        second = User.objects.db_manager("shard_1").create_user(email_on_shard("shard_1"))
+        self.assertNotEqual(first.id, second.id)
+
+    def test_signup_duplicate_email_on_other_shard(self):
+        email = email_on_shard("shard_1")
+        self.signup(email)
+        self.client.logout()
+
+        self.assertEqual(self.signup(email).status_code, 409)
+        self.assertEqual(ShardDirectory.objects.filter(username=email).count(), 1)
+
+    def test_failed_user_insert_rolls_back_directory(self):
+        email = email_on_shard("shard_1")
+        with mock.patch("account.models.UserProfile.objects.using",
+                        side_effect=IntegrityError):
+            self.assertEqual(self.signup(email).status_code, 409)
+
+        self.assertFalse(ShardDirectory.objects.filter(username=email).exists())
+        self.assertFalse(User.objects.using("shard_1").filter(username=email).exists())
+        self.assertEqual(self.signup(email).status_code, 302)
+
+    def test_login_and_session_on_shard(self):
+        email = email_on_shard("shard_1")
+        self.signup(email)
+        self.client.logout()
+
+        response = self.client.post("/accounts/login/",
+                                    {"username": email, "password": self.password})
+        self.assertEqual(response.status_code, 302)
+
+        response = self.client.get("/accounts/info/")
+        self.assertEqual(response.data["username"], email)
+        self.assertEqual(response.data["nickname"], email.split("@")[0])
+
+    def test_get_user_checks_directory_username(self):
+        # 沒有經過 directory 建立的 user 拿到了別人登記的 id
+        entry = ShardDirectory.objects.create(username="owner@example.com", shard="default")
+        User.objects.using("default").bulk_create([
+            User(id=entry.id, username="intruder@example.com"),
+        ])
+
+        self.assertIsNone(ShardedModelBackend().get_user(entry.id))
+
+    def test_find_and_reset_password_on_shard(self):
+        email = email_on_shard("shard_1")
+        user = User.objects.db_manager("shard_1").create_user(email, password=self.password)
+
+        with mock.patch("account.views.send_mail") as send_mail:
+            response = self.client.post("/accounts/find_password/", {"email": email})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(send_mail.called)
+
+        token = ResetPasswordToken.objects.using("shard_1").get(user_id=user.id)
+        self.assertFalse(ResetPasswordToken.objects.using("default").exists())
+
+        response = self.client.post(
+            "/accounts/reset_password/{}/".format(token.dynamic_url), {
+                "new_password": "newpass123",
+                "confirm_new_password": "newpass123",
+                "entry_token": token.entry_token,
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(User.objects.using("shard_1").get(pk=user.pk).check_password("newpass123"))
+
+    def test_bulk_lookup_across_shards(self):
+        users = [
+            User.objects.db_manager(shard).create_user(email_on_shard(shard))
+            for shard in ("default", "shard_1")
+        ]
+        staff = User.objects.create_superuser("admin", "admin@example.com", self.password)
+        self.client.force_login(staff, backend="account.backends.ShardedModelBackend")
+
+        response = self.client.post("/accounts/profiles/bulk/", json.dumps({
+            "user_ids": [user.id for user in users],
+            "emails": [user.username for user in users] + ["missing@example.com"],
+        }), content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        nicknames = [user.userprofile.nickname for user in users]
+        self.assertEqual(response.data["ids"],
+                         {str(user.id): nickname for user, nickname in zip(users, nicknames)})
+        self.assertEqual(response.data["emails"],
+                         {user.username: nickname for user, nickname in zip(users, nicknames)})
+
+    def test_bulk_lookup_rejects_bad_payload(self):
+        staff = User.objects.create_superuser("admin", "admin@example.com", self.password)
+        self.client.force_login(staff, backend="account.backends.ShardedModelBackend")
+
+        for payload in ({"user_ids": [True]}, {"emails": [{"a": 1}]}, {"emails": [[1]]}):
+            response = self.client.post("/accounts/profiles/bulk/", json.dumps(payload),
+                                        content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+
+    def test_save_profile_pipeline_uses_shard(self):
+        user = User.objects.db_manager("shard_1").create_user("oauth_user")
+
+        save_profile(None, username="oauth_user",
+                     details={"email": "oauth@example.com", "fullname": "Oauth User"})
+
+        profile = UserProfile.objects.using("shard_1").get(user_id=user.id)
+        self.assertEqual(profile.nickname, "Oauth User")
+        self.assertEqual(profile.contact_email, "oauth@example.com")
+
+    def test_unsharded_does_not_use_directory(self):
+        with override_settings(ACCOUNT_SHARDS=["default"]):
+            email = email_on_shard("default")
+            self.assertEqual(self.signup(email).status_code, 302)
+
+        self.assertTrue(User.objects.using("default").filter(username=email).exists())
+        self.assertFalse(ShardDirectory.objects.exists())
+
+
+class WarmupTest(TestCase):
+    multi_db = True
+
+    def test_runs_every_step(self):
+        timings = warmup()
+
+        self.assertEqual(list(timings), [name for name, step in WARMUP_STEPS])
+        self.assertTrue(all(seconds >= 0 for seconds in timings.values()))
+        for alias in connections:
+            self.assertIsNotNone(connections[alias].connection)
+
+    def test_skips_named_steps(self):
+        steps = (("first", mock.Mock()), ("second", mock.Mock()))
+        with mock.patch("demo.warmup.WARMUP_STEPS", steps):
+            timings = warmup(skip=["second"])
+
+        self.assertEqual(list(timings), ["first"])
+        steps[0][1].assert_called_once_with()
+        self.assertFalse(steps[1][1].called)
+
+    def test_connections_outlive_the_first_request(self):
+        # CONN_MAX_AGE 是 0 的話, warmup 開的 connection 在 request_started 就會被關掉
+        for alias in connections:
+            self.assertGreater(settings.DATABASES[alias]["CONN_MAX_AGE"], 0)
+
+    def load_wsgi(self, environ):
+        self.addCleanup(sys.modules.pop, "demo.wsgi", None)
+        sys.modules.pop("demo.wsgi", None)
+        with mock.patch.dict(os.environ, environ), \
+                mock.patch("demo.warmup.warmup") as warmup_mock:
+            importlib.import_module("demo.wsgi")
+        return warmup_mock
+
+    def test_wsgi_runs_warmup(self):
+        warmup_mock = self.load_wsgi({"DJANGO_WARMUP": "1",
+                                      "DJANGO_WARMUP_SKIP": "open_db_connections"})
+        warmup_mock.assert_called_once_with(skip=["open_db_connections"])
+
+    def test_wsgi_skips_warmup_when_disabled(self):
+        warmup_mock = self.load_wsgi({"DJANGO_WARMUP": "0"})
+        self.assertFalse(warmup_mock.called)
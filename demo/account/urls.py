@@ -17,6 +17,7 @@ from django.conf.urls import url, include
 from .views import (
         GeneralSignUpView, 
         UserInfoTestView,
+        BulkProfileLookupView,
         LoginView, 
         LogoutView, 
         ChangePasswordView, 
@@ -29,6 +30,7 @@ urlpatterns = [
     url(r'^login/$', LoginView.as_view()),
     url(r'^logout/$', LogoutView.as_view()),
     url(r'^info/$', UserInfoTestView.as_view()),
+    url(r'^profiles/bulk/$', BulkProfileLookupView.as_view()),
     url(r'^change_password/$', ChangePasswordView.as_view()),
     url(r'^find_password/$', FindPasswordView.as_view()),
     url(r'^reset_password/(?P<url_token>[0-9a-f]{64})/$', ResetPasswordView.as_view()),
@@ -5,6 +5,9 @@ PASSWORD_MIN_LENGTH = 6
 PASSWORD_PATTERN = r'[0-9a-zA-Z]+'
 password_regex = re.compile(PASSWORD_PATTERN)
 
+# 內部服務一次批次查詢的上限 (user_ids + emails)
+BULK_LOOKUP_MAX_SIZE = 200
+
 
 def is_valid_password(password):
     length_of_pwd = len(password)
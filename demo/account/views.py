@@ -9,18 +9,30 @@ from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError 
 from django.core.mail import send_mail
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Q
 from django.shortcuts import render, redirect
 from django.http import HttpResponse
 from django.utils import timezone
 
 from rest_framework import status
 from rest_framework.decorators import api_view
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
         
+from . import events
+from .events import record_auth_event
+from .lockout import account_key, failure_tracker, token_key
 from .models import UserProfile, ResetPasswordToken
-from .utils import is_valid_password
+from .sharding import get_shards, group_by_shard, shard_for_email, shard_for_username
+from .utils import BULK_LOOKUP_MAX_SIZE, is_valid_password
+
+
+def response_locked_out(locked_for):
+    return Response({"error": "嘗試次數過多，請在 {} 秒後再試".format(locked_for)},
+    status=status.HTTP_429_TOO_MANY_REQUESTS,
+    headers={"Retry-After": str(locked_for)})
 
 
 class UserInfoTestView(APIView): 
@@ -38,6 +50,79 @@ class UserInfoTestView(APIView):
         }
 
         return Response(user_info, status=status.HTTP_200_OK)
+
+
+class BulkProfileLookupView(APIView):
+    # 給內部服務用的批次查詢 API, 一次取得多個使用者的 nickname
+    # 原本要對每個使用者各打一次 UserInfoTestView (N+1 次 HTTP request)
+    # 這裡改成一次 request, 並且只用一個 select_related query 解決
+    #
+    # Precondition:
+    #   1. 必須是 staff 帳號 (內部服務也是用 staff 帳號來驗證)
+    #   2. 欄位: user_ids, emails, 兩者都是 list
+    #      總數不可超過 BULK_LOOKUP_MAX_SIZE
+    #
+    # 回傳的格式: {"ids": {id: nickname}, "emails": {email: nickname}, "latency_ms": ...}
+    # 查不到的 id, email 不會出現在結果裡面
+
+    permission_classes = (IsAdminUser,)
+
+    def post(self, request):
+        start_time = time.time()
+
+        user_ids = request.data.get("user_ids", [])
+        emails = request.data.get("emails", [])
+        if not isinstance(user_ids, list) or not isinstance(emails, list):
+            return Response({"error": "user_ids, emails 必須是 list"},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        number_of_keys = len(user_ids) + len(emails)
+        if number_of_keys == 0:
+            return Response({"error": "請輸入 user_ids 或 emails"},
+            status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        if number_of_keys > BULK_LOOKUP_MAX_SIZE:
+            return Response({"error": "一次最多查詢 {} 筆".format(BULK_LOOKUP_MAX_SIZE)},
+            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        # bool 是 int 的 subclass, 要另外排除, 不然 true 會被當成 id 1
+        if any(isinstance(user_id, bool) or not isinstance(user_id, int) for user_id in user_ids):
+            return Response({"error": "user_ids 格式錯誤"},
+            status=status.HTTP_400_BAD_REQUEST)
+
+        if any(not isinstance(email, str) for email in emails):
+            return Response({"error": "emails 格式錯誤"},
+            status=status.HTTP_400_BAD_REQUEST)
+
+        requested_ids = set(user_ids)
+        requested_emails = set(emails)
+        nickname_by_id = {}
+        nickname_by_email = {}
+
+        # 每個 shard 只查一次, 只抓需要的欄位, 並且用 select_related 把 user 一起 join 進來
+        for shard, (shard_user_ids, shard_emails) in group_by_shard(user_ids, emails).items():
+            profiles = (
+                UserProfile.objects.using(shard)
+                .select_related("user")
+                .filter(Q(user_id__in=shard_user_ids) | Q(user__username__in=shard_emails))
+                .only("nickname", "user__username")
+            )
+
+            for profile in profiles:
+                if profile.user_id in requested_ids:
+                    nickname_by_id[str(profile.user_id)] = profile.nickname
+                if profile.user.username in requested_emails:
+                    nickname_by_email[profile.user.username] = profile.nickname
+
+        latency_ms = round((time.time() - start_time) * 1000, 3)
+        result = {
+            "ids": nickname_by_id,
+            "emails": nickname_by_email,
+            "latency_ms": latency_ms,
+        }
+
+        return Response(result, status=status.HTTP_200_OK,
+        headers={"X-Batch-Latency-Ms": str(latency_ms)})
    
 
 class LoginView(APIView):
@@ -74,13 +159,23 @@ class LoginView(APIView):
         if username == "" or password == "":
             return Response({"error": "請輸入username, password"},
             status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+        # 被鎖定的帳號直接擋掉，不做 authenticate (password hashing 很貴)
+        locked_for = failure_tracker.locked_for(account_key(username))
+        if locked_for:
+            record_auth_event(request, events.LOCKED_OUT, username)
+            return response_locked_out(locked_for)
         
         user = authenticate(username=username, password=password)
         if user is None:
+            failure_tracker.record_failure(account_key(username))
+            record_auth_event(request, events.LOGIN_FAILED, username)
             return Response({"error": "帳戶驗證錯誤, 如果是 FB, Google 使用者，請改用 FB, Google 登入"},
             status=status.HTTP_401_UNAUTHORIZED)
          
+        failure_tracker.reset(account_key(username))
         login(request, user)
+        record_auth_event(request, events.LOGIN, user.username)
         
         return redirect("/")
         # return Response(status=status.HTTP_200_OK)
@@ -97,7 +192,9 @@ class LogoutView(APIView):
             return Response({"error": "使用者尚未登入"},
             status=status.HTTP_401_UNAUTHORIZED)
 
+        username = request.user.username
         logout(request)
+        record_auth_event(request, events.LOGOUT, username)
         return Response(status=status.HTTP_200_OK)
 
     def get(self, request):
@@ -156,12 +253,22 @@ class GeneralSignUpView(APIView):
             status=status.HTTP_400_BAD_REQUEST)
 
         # check user exists or not
-        exist_username = User.objects.filter(username=username).exists()
+        exist_username = User.objects.using(shard_for_username(username)) \
+            .filter(username=username).exists()
         if exist_username:
             return Response({"error":"帳號已被註冊"},
             status=status.HTTP_409_CONFLICT)
-        
-        user = User.objects.create_user(username=username, password=password)
+
+        # sharding 的時候建立 user 會先在 default 的 directory 登記 (.models.allocate_user_id)
+        # 兩個 DB 包在同一個 transaction 裡, 建立失敗的話 directory 也會一起 rollback
+        shard = shard_for_email(username)
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS), transaction.atomic(using=shard):
+                user = User.objects.db_manager(shard).create_user(
+                    username=username, password=password)
+        except IntegrityError:
+            return Response({"error":"帳號已被註冊"},
+            status=status.HTTP_409_CONFLICT)
         # 同步 nickname, contact_email
         # 不用 check user profile model 是不是有建立連結
         # 因為我們已經利用 signal (.models.create_profile) 的方式跟 db 同步
@@ -174,6 +281,7 @@ class GeneralSignUpView(APIView):
         
         user = authenticate(username=username, password=password)
         login(request, user)
+        record_auth_event(request, events.SIGNUP, user.username)
 
         return redirect("/")
         # return Response(status=status.HTTP_201_CREATED)
@@ -221,11 +329,13 @@ class ChangePasswordView(APIView):
 
         user = request.user
         if not user.check_password(current_password):
+            record_auth_event(request, events.PASSWORD_CHANGE_FAILED, user.username)
             return Response({"error":"與目前密碼不符"},
             status=status.HTTP_400_BAD_REQUEST)
 
         user.set_password(new_password)
         user.save()
+        record_auth_event(request, events.PASSWORD_CHANGE, user.username)
         
         return Response(status=status.HTTP_200_OK)
 
@@ -252,7 +362,8 @@ class FindPasswordView(APIView):
         
         # TODO 感覺上，因為已經知道 user 了，利用 user.resetpasswordtoken 似乎會比較快？
         # 但是會觸發 RelatedObjectDoesNotExist, 目前還不知道怎麼抓取
-        rt, created = ResetPasswordToken.objects.get_or_create(user=user)
+        # token 要建在 user 所在的 shard 上
+        rt, created = ResetPasswordToken.objects.db_manager(user._state.db).get_or_create(user=user)
         rt.dynamic_url = url_token
         rt.entry_token = entry_token
         rt.expire_time = accessible_time
@@ -321,7 +432,7 @@ class FindPasswordView(APIView):
             status=status.HTTP_400_BAD_REQUEST)
         
         try:
-            user = User.objects.get(username=email)
+            user = User.objects.using(shard_for_username(email)).get(username=email)
         except User.DoesNotExist:
             return Response({"error": "沒有這個 Email 帳號"},
             status=status.HTTP_403_FORBIDDEN)
@@ -347,6 +458,7 @@ class ResetPasswordView(APIView):
     #   
     #   不讓已登入的人來找密碼
     #   設定成功之後，沒有限制重置次數（在允許時間內都可以)
+    #   entry_token 只有 6 個字元，所以驗證碼錯太多次會依照 url_token 鎖定
     
     def __response_block_already_login(self, request):
         return Response({"error":"使用者已登入，不可重置密碼"},
@@ -358,14 +470,29 @@ class ResetPasswordView(APIView):
         
         return render(request, "reset_password.html")
 
+    def __find_reset_password_token(self, url_token):
+        # 連結裡面看不出來 user 在哪個 shard, 所以每個 shard 都找一次
+        # 驗證碼錯太多次的連結在這之前就會被 lockout 擋掉
+        for shard in get_shards():
+            try:
+                return ResetPasswordToken.objects.using(shard).get(dynamic_url=url_token)
+            except ResetPasswordToken.DoesNotExist:
+                continue
+
+        return None
+
     def post(self, request, url_token):
         if request.user.is_authenticated():
             return self.__response_block_already_login(request)
 
+        # 在查 DB 之前先檢查這個連結是不是因為驗證碼錯太多次被鎖定
+        locked_for = failure_tracker.locked_for(token_key(url_token))
+        if locked_for:
+            return response_locked_out(locked_for)
+
         # Dynamic URL Token Validation
-        try:
-            user_reset_password_token = ResetPasswordToken.objects.get(dynamic_url=url_token)
-        except ResetPasswordToken.DoesNotExist:
+        user_reset_password_token = self.__find_reset_password_token(url_token)
+        if user_reset_password_token is None:
             return Response({"error": "無效的連結"},
             status=status.HTTP_403_FORBIDDEN)
         
@@ -385,6 +512,10 @@ class ResetPasswordView(APIView):
         
         password_confirm_failed = (new_password != confirm_new_password)
         entry_token_invalid = (entry_token != user_reset_password_token.entry_token)
+        if entry_token_invalid:
+            failure_tracker.record_failure(token_key(url_token))
+            record_auth_event(request, events.PASSWORD_RESET_FAILED,
+                              user_reset_password_token.user.username)
         if password_confirm_failed or entry_token_invalid:
             return Response({"error":"輸入不一致或是驗證碼錯誤"},
             status=status.HTTP_400_BAD_REQUEST)
@@ -397,5 +528,7 @@ class ResetPasswordView(APIView):
         user = user_reset_password_token.user
         user.set_password(new_password)
         user.save()
+        failure_tracker.reset(token_key(url_token))
+        record_auth_event(request, events.PASSWORD_RESET, user.username)
 
         return Response(status=status.HTTP_200_OK)
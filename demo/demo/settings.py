@@ -82,19 +82,64 @@ TEMPLATES = [
     },
 ]
 
+if not DEBUG:
+    # production 用 cached loader, warmup (demo/warmup.py) 載入過的 template 才會留在 memory
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'demo.wsgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/1.10/ref/settings/#databases
 
+# 每個 request 結束時不要關掉 DB connection, 保留 CONN_MAX_AGE 秒給下一個 request 使用
+# 設成 0 的話 warmup 跟 gunicorn post_fork 開好的 connection 在第一個 request 開始時就會被關掉
+CONN_MAX_AGE = int(os.environ.get('DJANGO_CONN_MAX_AGE', 60))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': CONN_MAX_AGE,
     }
 }
 
+# Account sharding (account.sharding)
+# User, UserProfile, ResetPasswordToken 依照 email 的 hash 分散到 ACCOUNT_SHARDS
+# 本機測試: ACCOUNT_SHARD_COUNT=3 會多開 shard_1, shard_2 兩個 sqlite DB
+# 每個 shard 都要 migrate: ./manage.py migrate --database shard_1
+ACCOUNT_SHARD_COUNT = int(os.environ.get('ACCOUNT_SHARD_COUNT', 1))
+for shard_index in range(1, ACCOUNT_SHARD_COUNT):
+    DATABASES['shard_%d' % shard_index] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_shard_%d.sqlite3' % shard_index),
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+    }
+
+ACCOUNT_SHARDS = ['default'] + ['shard_%d' % i for i in range(1, ACCOUNT_SHARD_COUNT)]
+DATABASE_ROUTERS = ['account.routers.AccountShardRouter']
+
+
+# Session
+# 預設使用 Django 的 db engine
+# account.session_backend: process 內 LRU + 共用 cache, 修改 session 時批次寫回 DB
+# 要使用的話 CACHES["default"] 一定要是 memcached 或 redis 這類所有 worker 共用的 cache,
+# 只要有兩個以上的 process (例如 gunicorn 的多個 worker) LocMemCache 就會讓登出失效,
+# 所以 SESSION_CACHE_ALIAS 是 LocMemCache 的時候啟動就會丟出 ImproperlyConfigured
+# 登出會在共用 cache 留下 tombstone, 其他 worker 的 LRU 命中時也會檢查, 所以登出馬上生效
+# ACCOUNT_SESSION_LOCAL_TTL 只影響別的 worker 修改過的 session 多久之後才讀得到新的資料
+# SESSION_ENGINE = "account.session_backend"
+SESSION_ENGINE = "django.contrib.sessions.backends.db"
+ACCOUNT_SESSION_LOCAL_MAX_ENTRIES = 10000
+ACCOUNT_SESSION_LOCAL_TTL = 2.0
+ACCOUNT_SESSION_FLUSH_INTERVAL = 1.0
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -118,7 +163,7 @@ AUTHENTICATION_BACKENDS = (
     'social_core.backends.google.GoogleOAuth2',
     'social_core.backends.facebook.FacebookOAuth2',
     'rest_framework_social_oauth2.backends.DjangoOAuth2',
-    'django.contrib.auth.backends.ModelBackend',
+    'account.backends.ShardedModelBackend',
 )
 
 REST_FRAMEWORK = {
@@ -145,6 +190,23 @@ SOCIAL_AUTH_PIPELINE = (
     'account.pipelines.save_profile',
 )
 
+# Authentication event log (account.events)
+# 事件先放在 memory buffer, 再由 background thread 批次寫出
+# sink: "db" -> AuthEvent table, "jsonl" -> rotating jsonl file
+ACCOUNT_AUTH_EVENT_SINK = "db"
+ACCOUNT_AUTH_EVENT_BUFFER_SIZE = 10000
+ACCOUNT_AUTH_EVENT_FLUSH_INTERVAL = 2.0
+ACCOUNT_AUTH_EVENT_LOG_FILE = os.path.join(BASE_DIR, "auth_events.jsonl")
+
+# Brute-force lockout (account.lockout)
+# "local" 的失敗次數只存在單一 process 裡, 只適合 runserver 這種單一 process 的情況
+# 用 gunicorn.conf.py 開多個 worker (或多台機器) 時, 每個 worker 會各算各的,
+# 實際上的門檻會變成 worker 數量倍, 所以一定要改成 "cache" 並設定共用的 CACHES (memcached, redis)
+ACCOUNT_LOCKOUT_BACKEND = "local"
+ACCOUNT_LOCKOUT_THRESHOLD = 5
+ACCOUNT_LOCKOUT_BASE_SECONDS = 30
+ACCOUNT_LOCKOUT_MAX_SECONDS = 60 * 60
+
 SOCIAL_AUTH_ADMIN_USER_SEARCH_FIELDS = ['username']
 
 with open("demo/oauth_credentials.json") as foauth:
@@ -0,0 +1,35 @@
+"""
+Settings for running the account tests.
+
+    $ ./manage.py test account --settings=demo.test_settings
+
+Adds a second SQLite database (shard_1) so the sharding code paths are
+exercised, and swaps slow or external services for local ones.
+"""
+
+import os
+
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, CONN_MAX_AGE, DATABASES
+
+DATABASES = dict(DATABASES)
+DATABASES['shard_1'] = {
+    'ENGINE': 'django.db.backends.sqlite3',
+    'NAME': os.path.join(BASE_DIR, 'db_test_shard_1.sqlite3'),
+    'CONN_MAX_AGE': CONN_MAX_AGE,
+}
+ACCOUNT_SHARD_COUNT = 2
+ACCOUNT_SHARDS = ['default', 'shard_1']
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+# 測試的時候不讓 background thread 自己 flush, 由測試自己呼叫
+ACCOUNT_AUTH_EVENT_FLUSH_INTERVAL = 60 * 60
+ACCOUNT_SESSION_FLUSH_INTERVAL = 60 * 60
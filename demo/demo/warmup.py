@@ -0,0 +1,104 @@
+"""
+Warm up a worker before it takes traffic.
+
+Every step here is something the first request would otherwise pay for:
+importing the views (DRF, social-auth), compiling the URL patterns,
+loading templates, loading the password hashers and opening the database
+connections. With a preforking server (see gunicorn.conf.py) this runs
+once in the master, and the workers share the warmed state through
+copy-on-write.
+
+Opened connections only survive the first request when CONN_MAX_AGE is
+non-zero (see settings.py); otherwise request_started closes them again.
+Steps named in DJANGO_WARMUP_SKIP (comma separated) are not run, which
+gunicorn.conf.py uses to leave the connections to each worker.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import get_backends
+from django.contrib.auth.hashers import get_hasher, get_hashers
+from django.db import connections
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.urls import get_resolver, resolve, Resolver404
+
+WARMUP_MODULES = (
+    "account.views",
+    "account.pipelines",
+    "demo.views",
+)
+
+
+def import_modules():
+    for module in WARMUP_MODULES:
+        import_module(module)
+
+    # DRF 的 authentication class 跟 auth backend 都是第一次用到才 import
+    from rest_framework.settings import api_settings
+    api_settings.DEFAULT_AUTHENTICATION_CLASSES
+    api_settings.DEFAULT_PERMISSION_CLASSES
+    get_backends()
+
+
+def compile_url_patterns():
+    resolver = get_resolver()
+    # reverse_dict 會觸發 _populate(), 把所有的 pattern compile 起來
+    resolver.reverse_dict
+    try:
+        resolve("/")
+    except Resolver404:
+        pass
+
+
+def load_templates():
+    for template_dir in settings.TEMPLATES[0].get("DIRS", []):
+        for name in sorted(os.listdir(template_dir)):
+            if not name.endswith(".html"):
+                continue
+            try:
+                get_template(name)
+            except TemplateDoesNotExist:
+                pass
+
+
+def load_hashers():
+    get_hashers()
+    get_hasher("default")
+
+
+def open_db_connections():
+    for alias in connections:
+        connections[alias].ensure_connection()
+
+
+def close_db_connections():
+    # fork 之前要把 connection 關掉，不然 worker 之間會共用同一個 socket
+    for connection in connections.all():
+        connection.close()
+
+
+WARMUP_STEPS = (
+    ("import_modules", import_modules),
+    ("compile_url_patterns", compile_url_patterns),
+    ("load_templates", load_templates),
+    ("load_hashers", load_hashers),
+    ("open_db_connections", open_db_connections),
+)
+
+
+def warmup(skip=()):
+    """Run every warmup step not in skip and return the seconds spent on each."""
+    timings = OrderedDict()
+    for name, step in WARMUP_STEPS:
+        if name in skip:
+            continue
+        start_time = time.time()
+        step()
+        timings[name] = time.time() - start_time
+
+    return timings
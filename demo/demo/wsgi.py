@@ -5,6 +5,11 @@ It exposes the WSGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/1.10/howto/deployment/wsgi/
+
+Unless DJANGO_WARMUP=0, the worker is warmed up (see demo/warmup.py) before
+the callable is handed to the server, so the first request does not pay for
+imports, URL compilation, template loading or opening DB connections.
+Steps named in DJANGO_WARMUP_SKIP (comma separated) are left out.
 """
 
 import os
@@ -14,3 +19,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "demo.settings")
 
 application = get_wsgi_application()
+
+if os.environ.get("DJANGO_WARMUP", "1") != "0":
+    from .warmup import warmup
+    warmup(skip=os.environ.get("DJANGO_WARMUP_SKIP", "").split(","))
@@ -0,0 +1,46 @@
+# Gunicorn config for production
+# 使用方式 (在 demo/ 底下): gunicorn -c gunicorn.conf.py demo.wsgi:application
+#
+# preload_app 會讓 master 先 import demo.wsgi, 也就是先跑完 warmup
+# 之後 fork 出來的 worker 透過 copy-on-write 共用已經 warm 好的 module, URL pattern 跟 template
+#
+# 多個 worker 之間不會共用 memory, 所以 settings 裡的 ACCOUNT_LOCKOUT_BACKEND 要設成 "cache",
+# 並且 CACHES 要設定成 memcached, redis 這類共用的 cache
+import gc
+import multiprocessing
+import os
+
+# master 開的 DB connection 在 fork 之前就要關掉, 所以 master 不開, 留給每個 worker 在 post_fork 開
+# 這個檔案會比 preload 的 demo.wsgi 先執行
+os.environ.setdefault("DJANGO_WARMUP_SKIP", "open_db_connections")
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "sync"
+preload_app = True
+
+# 定期重開 worker, 避免 memory 慢慢長大
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+timeout = 30
+keepalive = 2
+
+
+def when_ready(server):
+    # warmup 產生的 object 之後都不會被回收，freeze 之後 GC 就不會去碰它們
+    # 不然 GC 更新 reference count 的時候會讓 copy-on-write 的 page 被複製
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+
+
+def pre_fork(server, worker):
+    # 以防 master 在 import 的時候開過 DB connection, fork 之前要關掉
+    from demo.warmup import close_db_connections
+    close_db_connections()
+
+
+def post_fork(server, worker):
+    # 每個 worker 開自己的 DB connection, 第一個 request 就不用等連線
+    # settings 的 CONN_MAX_AGE 是 0 的話, 第一個 request 開始時就會被關掉
+    from demo.warmup import open_db_connections
+    open_db_connections()